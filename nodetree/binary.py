@@ -0,0 +1,327 @@
+"""
+Compact binary script format.
+
+Layout, after a versioned header and a block of counts:
+
+    string table    every label, type name, param name and string
+                    value, stored once and referred to by index: a
+                    uint32 length array per kind, text as a single
+                    UTF-8 blob decoded in one go, and raw bytes
+    node table      uint32 label, type, input, param and extra counts
+                    per node, in dependency order
+    input table     uint32 references to earlier nodes
+    values          tagged varint-encoded param and meta values
+
+Node inputs are integer references rather than label strings, which
+lets a loader wire up the whole script in a single pass.  Decoding
+yields exactly the dictionary that was encoded.
+"""
+
+from __future__ import absolute_import
+
+import sys
+import array
+import struct
+
+from . import exceptions
+
+
+MAGIC = b"NTSB"
+VERSION = 2
+HEADER = struct.Struct(">4sH")
+COUNTS = struct.Struct("<8I")
+DOUBLE = struct.Struct(">d")
+NODE_COLUMNS = 5
+
+NONE, TRUE, FALSE, INT, FLOAT, STRING, LIST, TUPLE, DICT = range(9)
+
+try:
+    TEXT_TYPE, INT_TYPES = unicode, (int, long)
+except NameError:
+    TEXT_TYPE, INT_TYPES = str, (int,)
+
+NODE_KEYS = ("type", "inputs", "params")
+
+UINT32 = "I" if array.array("I").itemsize == 4 else "L"
+
+
+def pack_uints(values):
+    """Pack a sequence of ints as little-endian uint32s."""
+    arr = array.array(UINT32, values)
+    if sys.byteorder == "big":
+        arr.byteswap()
+    return arr.tobytes() if hasattr(arr, "tobytes") else arr.tostring()
+
+
+def unpack_uints(data):
+    """Unpack little-endian uint32s to a list of ints."""
+    arr = array.array(UINT32)
+    if hasattr(arr, "frombytes"):
+        arr.frombytes(data)
+    else:
+        arr.fromstring(data)
+    if sys.byteorder == "big":
+        arr.byteswap()
+    return arr.tolist()
+
+
+class Writer(object):
+    """Encode a serialized script dictionary."""
+    def __init__(self):
+        self._strings = {}
+        self._kinds = bytearray()
+        self._text = []
+        self._raw = []
+
+    def intern(self, value):
+        """Return the string table index for a string."""
+        key = (type(value), value)
+        index = self._strings.get(key)
+        if index is None:
+            index = self._strings[key] = len(self._kinds)
+            istext = isinstance(value, TEXT_TYPE)
+            self._kinds.append(0 if istext else 1)
+            (self._text if istext else self._raw).append(value)
+        return index
+
+    def dumps(self, script):
+        """Encode a script dictionary to bytes."""
+        values = bytearray()
+        meta = [(k, v) for k, v in script.items() if k.startswith("__")]
+        write_uint(values, len(meta))
+        for key, value in meta:
+            write_uint(values, self.intern(key))
+            self.write_value(values, value)
+        order = dependency_order(script)
+        index = dict((name, i) for i, name in enumerate(order))
+        nodes, inputs = [], []
+        for name in order:
+            n = script[name]
+            extras = [(k, v) for k, v in n.items() if k not in NODE_KEYS]
+            nodes.extend((self.intern(name), self.intern(n["type"]),
+                    len(n["inputs"]), len(n["params"]), len(extras)))
+            for label in n["inputs"]:
+                if label is None:
+                    inputs.append(0)
+                elif label in index:
+                    inputs.append((index[label] + 1) << 1)
+                else:
+                    # dangling reference: keep the label itself
+                    inputs.append((self.intern(label) << 1) | 1)
+            for pair in n["params"]:
+                write_uint(values, (self.intern(pair[0]) << 1) \
+                        | int(isinstance(pair, list)))
+                self.write_value(values, pair[1])
+            for key, value in extras:
+                write_uint(values, self.intern(key))
+                self.write_value(values, value)
+
+        text = u"".join(self._text).encode("utf-8")
+        raw = b"".join(self._raw)
+        return b"".join([
+            HEADER.pack(MAGIC, VERSION),
+            COUNTS.pack(len(self._kinds), len(self._text), len(text),
+                len(self._raw), len(raw), len(order), len(inputs),
+                len(values)),
+            bytes(self._kinds),
+            pack_uints(len(t) for t in self._text), text,
+            pack_uints(len(r) for r in self._raw), raw,
+            pack_uints(nodes), pack_uints(inputs), bytes(values),
+        ])
+
+    def write_value(self, out, value):
+        """Encode a tagged parameter or meta value."""
+        if value is None:
+            out.append(NONE)
+        elif value is True:
+            out.append(TRUE)
+        elif value is False:
+            out.append(FALSE)
+        elif isinstance(value, INT_TYPES):
+            out.append(INT)
+            write_uint(out, value << 1 if value >= 0 else (~value << 1) | 1)
+        elif isinstance(value, float):
+            out.append(FLOAT)
+            out.extend(DOUBLE.pack(value))
+        elif isinstance(value, (bytes, TEXT_TYPE)):
+            out.append(STRING)
+            write_uint(out, self.intern(value))
+        elif isinstance(value, (list, tuple)):
+            out.append(LIST if isinstance(value, list) else TUPLE)
+            write_uint(out, len(value))
+            for item in value:
+                self.write_value(out, item)
+        elif isinstance(value, dict):
+            out.append(DICT)
+            write_uint(out, len(value))
+            for key, item in value.items():
+                self.write_value(out, key)
+                self.write_value(out, item)
+        else:
+            raise exceptions.ScriptError(
+                    "cannot encode value of type '%s'" % type(value).__name__)
+
+
+class Reader(object):
+    """Decode a binary script.  The tables and script meta are read
+    up front; nodes are assembled lazily by `nodes`."""
+    def __init__(self, data):
+        if len(data) < HEADER.size + COUNTS.size:
+            raise exceptions.ScriptError("truncated binary script")
+        magic, version = HEADER.unpack_from(data)
+        if magic != MAGIC:
+            raise exceptions.ScriptError("not a binary script")
+        if version != VERSION:
+            raise exceptions.ScriptError(
+                    "unsupported binary script version: %d" % version)
+        self.version = version
+        nstrings, ntext, textsize, nraw, rawsize, nnodes, ninputs, \
+                valuesize = COUNTS.unpack_from(data, HEADER.size)
+        pos = HEADER.size + COUNTS.size
+        blocks = []
+        for size in (nstrings, ntext * 4, textsize, nraw * 4, rawsize,
+                nnodes * NODE_COLUMNS * 4, ninputs * 4, valuesize):
+            blocks.append(data[pos:pos + size])
+            pos += size
+        if pos > len(data):
+            raise exceptions.ScriptError("truncated binary script")
+        kinds, textlens, text, rawlens, raw, nodes, inputs, values = blocks
+
+        texts, rawstrings = [], []
+        text, offset = text.decode("utf-8"), 0
+        for size in unpack_uints(textlens):
+            texts.append(text[offset:offset + size])
+            offset += size
+        offset = 0
+        for size in unpack_uints(rawlens):
+            rawstrings.append(raw[offset:offset + size])
+            offset += size
+        texts, rawstrings = iter(texts), iter(rawstrings)
+        self._table = [next(rawstrings) if kind else next(texts) \
+                for kind in bytearray(kinds)]
+        self._nodes = unpack_uints(nodes)
+        self._inputs = unpack_uints(inputs)
+        self._buf = bytearray(values)
+        self._pos = 0
+        self.meta = [(self.read_string(), self.read_value()) \
+                for i in range(self.read_uint())]
+
+    def nodes(self):
+        """Yield (label, type, inputs, params, extras) for each node,
+        every node after all of those it takes input from."""
+        table, columns = self._table, self._nodes
+        labels = [table[i] for i in columns[0::NODE_COLUMNS]]
+        types = [table[i] for i in columns[1::NODE_COLUMNS]]
+        refs = [None if ref == 0 else table[ref >> 1] if ref & 1 \
+                else labels[(ref >> 1) - 1] for ref in self._inputs]
+        read_uint, read_value = self.read_uint, self.read_value
+        pos = 0
+        for label, nodetype, ninputs, nparams, nextras in zip(labels, types,
+                columns[2::NODE_COLUMNS], columns[3::NODE_COLUMNS],
+                columns[4::NODE_COLUMNS]):
+            inputs = refs[pos:pos + ninputs]
+            pos += ninputs
+            params = []
+            for j in range(nparams):
+                ref = read_uint()
+                pair = (table[ref >> 1], read_value())
+                params.append(list(pair) if ref & 1 else pair)
+            extras = [(table[read_uint()], read_value()) \
+                    for j in range(nextras)] if nextras else []
+            yield label, nodetype, inputs, params, extras
+
+    def read_uint(self):
+        """Read an unsigned LEB128 varint from the values block."""
+        buf, pos = self._buf, self._pos
+        result = shift = 0
+        while True:
+            byte = buf[pos]
+            pos += 1
+            result |= (byte & 0x7f) << shift
+            if not byte & 0x80:
+                break
+            shift += 7
+        self._pos = pos
+        return result
+
+    def read_string(self):
+        """Read a string table reference."""
+        return self._table[self.read_uint()]
+
+    def read_value(self):
+        """Decode a tagged value."""
+        tag = self._buf[self._pos]
+        self._pos += 1
+        if tag == NONE:
+            return None
+        elif tag == TRUE:
+            return True
+        elif tag == FALSE:
+            return False
+        elif tag == INT:
+            raw = self.read_uint()
+            return ~(raw >> 1) if raw & 1 else raw >> 1
+        elif tag == FLOAT:
+            value = DOUBLE.unpack_from(bytes(self._buf[self._pos:self._pos + 8]))[0]
+            self._pos += 8
+            return value
+        elif tag == STRING:
+            return self.read_string()
+        elif tag in (LIST, TUPLE):
+            items = [self.read_value() for i in range(self.read_uint())]
+            return items if tag == LIST else tuple(items)
+        elif tag == DICT:
+            return dict((self.read_value(), self.read_value()) \
+                    for i in range(self.read_uint()))
+        raise exceptions.ScriptError("bad value tag in binary script: %d" % tag)
+
+
+def write_uint(out, value):
+    """Append an unsigned LEB128 varint."""
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def dependency_order(script):
+    """Order the nodes of a script dictionary so that each comes
+    after every node it takes input from."""
+    order, state = [], {}
+    for root in script:
+        if root.startswith("__") or root in state:
+            continue
+        stack = [(root, iter(script[root]["inputs"]))]
+        state[root] = False
+        while stack:
+            name, inputs = stack[-1]
+            for label in inputs:
+                if label is None or label not in script:
+                    continue
+                if label not in state:
+                    state[label] = False
+                    stack.append((label, iter(script[label]["inputs"])))
+                    break
+                if state[label] is False:
+                    raise exceptions.CircularDagError(
+                            "input '%s' is circular" % label, name)
+            else:
+                stack.pop()
+                state[name] = True
+                order.append(name)
+    return order
+
+
+def dumps(script):
+    """Encode a serialized script dictionary to bytes."""
+    return Writer().dumps(script)
+
+
+def loads(data):
+    """Decode bytes to a serialized script dictionary."""
+    reader = Reader(data)
+    out = dict(reader.meta)
+    for label, nodetype, inputs, params, extras in reader.nodes():
+        out[label] = dict(type=nodetype, inputs=inputs, params=params)
+        out[label].update(extras)
+    return out
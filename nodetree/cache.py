@@ -1,5 +1,11 @@
 """Classes for customising node caching."""
 
+from __future__ import absolute_import
+
+import tempfile
+
+from .transport import SharedMemoryTransport, numpy
+
 
 class BasicCacher(object):
     """Basic in-memory caching."""
@@ -7,6 +13,12 @@ class BasicCacher(object):
         self._cache = {}
         self.logger = logger
 
+    def allocate(self, node, shape, dtype):
+        """Return an empty array for a node to write its output into."""
+        if numpy is None:
+            raise ImportError("numpy is required to allocate outputs")
+        return numpy.empty(shape, dtype=dtype)
+
     def set_cache(self, node, data):
         """Store some data on the object."""
         self._cache[node.label] = data
@@ -21,8 +33,7 @@ class BasicCacher(object):
 
     def clear_cache(self, node):
         """Clear a node's cache."""
-        if self._cache.get(node.label):
-            del self._cache[node.label]
+        self._cache.pop(node.label, None)
 
     def clear(self):
         """Clear the entire cache."""
@@ -32,3 +43,91 @@ class BasicCacher(object):
         return "<%s>" % self.__class__.__name__
 
 
+class SharedMemoryCacher(BasicCacher):
+    """Cache that places buffer-protocol outputs in shared memory
+    segments.  The cache holds only the segment handles, so outputs
+    can be handed to other processes without pickling, and each
+    segment lives exactly as long as its cache entry.
+
+    Caching an ordinary output copies it into a segment once.  A node
+    that builds its output in an array from `allocate` writes straight
+    into the segment, and caching that array costs no copy at all."""
+    def __init__(self, logger=None, transport=None):
+        super(SharedMemoryCacher, self).__init__(logger=logger)
+        self.transport = transport if transport is not None \
+                else SharedMemoryTransport(logger=logger)
+        self._pending = {}
+
+    def allocate(self, node, shape, dtype):
+        """Return an empty array backed by a new segment."""
+        if numpy is None:
+            raise ImportError("numpy is required to allocate outputs")
+        dtype = numpy.dtype(dtype)
+        size = dtype.itemsize
+        for dim in shape:
+            size *= dim
+        handle = self.transport.allocate(size, "ndarray", dtype.str,
+                tuple(shape))
+        self.transport.release(self._pending.pop(node.label, (None,))[0])
+        view = self.transport.get(handle)
+        self._pending[node.label] = (handle, view)
+        return view
+
+    def store(self, data):
+        """Return what the cache holds for some data."""
+        return self.transport.put(data)
+
+    def set_cache(self, node, data):
+        """Store data in a segment, releasing any previous one.  An
+        array obtained from `allocate` is adopted without copying."""
+        handle, view = self._pending.pop(node.label, (None, None))
+        self.clear_cache(node)
+        if handle is not None and data is view:
+            self._cache[node.label] = handle
+            return
+        self.transport.release(handle)
+        self._cache[node.label] = self.store(data)
+
+    def get_cache(self, node):
+        """Return a zero-copy view of the cached data."""
+        return self.transport.get(self._cache.get(node.label))
+
+    def get_handle(self, node):
+        """Return the segment handle for a node's cached data,
+        suitable for passing to another process."""
+        return self._cache.get(node.label)
+
+    def clear_cache(self, node):
+        """Clear a node's cache and release its segment."""
+        self.transport.release(self._cache.pop(node.label, None))
+
+    def clear(self):
+        """Clear the entire cache and release all segments."""
+        for handle in self._cache.values():
+            self.transport.release(handle)
+        for handle, view in self._pending.values():
+            self.transport.release(handle)
+        self._cache = {}
+        self._pending = {}
+
+
+class SpillCacher(SharedMemoryCacher):
+    """Cache that spills transportable outputs of at least
+    `threshold` bytes to memory-mapped files on disk, keeping
+    smaller ones, and anything else, in memory.  Spilled data is returned as a
+    zero-copy view of the mapped file, so the OS can page it
+    out rather than it counting against resident memory.  The
+    files are removed when the cache entry is cleared."""
+    def __init__(self, logger=None, threshold=64 * 1024 * 1024, directory=None):
+        super(SpillCacher, self).__init__(logger=logger,
+                transport=SharedMemoryTransport(logger=logger,
+                    directory=directory if directory is not None \
+                        else tempfile.gettempdir()))
+        self.threshold = threshold
+
+    def store(self, data):
+        """Spill data to disk if it is large enough."""
+        size = self.transport.nbytes(data)
+        if size is not None and size >= self.threshold:
+            return self.transport.put(data)
+        return data
@@ -0,0 +1,101 @@
+"""
+Evaluation contexts.
+
+An evaluation context holds the per-run state of a script evaluation:
+input data, parameter overrides and results.  While a context is
+active in a thread, nodes read their params and input data from it
+rather than from themselves, so any number of threads can evaluate
+the same Script at once, each in its own context.
+"""
+
+from __future__ import absolute_import
+
+import threading
+
+
+_local = threading.local()
+
+
+def current():
+    """Get the evaluation context active in this thread, if any."""
+    stack = getattr(_local, "stack", None)
+    return stack[-1] if stack else None
+
+
+class EvalContext(object):
+    """
+    Per-evaluation state for a script.
+
+    `params` overrides node params, as {label: {param: value}}, and
+    `inputs` supplies node outputs directly, as {label: data}.  With
+    `shared_cache`, nodes unaffected by either read the data already
+    cached on the script, without ever writing to it.
+    """
+    def __init__(self, params=None, inputs=None, shared_cache=False):
+        self.params = params if params is not None else {}
+        self.inputs = inputs if inputs is not None else {}
+        self.shared_cache = shared_cache
+        self.results = {}
+        self._params = {}
+        self._inputdata = {}
+        self._clean = {}
+
+    def __enter__(self):
+        if getattr(_local, "stack", None) is None:
+            _local.stack = []
+        _local.stack.append(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        _local.stack.pop()
+
+    def get_params(self, n):
+        """Get a node's params, with any overrides applied."""
+        params = self._params.get(n)
+        if params is None:
+            params = self._params[n] = dict(n._node_params)
+            params.update(self.params.get(n.label, {}))
+        return params
+
+    def get_inputdata(self, n):
+        """Get the list holding a node's input data for this run."""
+        data = self._inputdata.get(n)
+        if data is None:
+            data = self._inputdata[n] = [None for i in range(n.arity)]
+        return data
+
+    def has_result(self, n):
+        """Check if a node's output is known in this context."""
+        return n in self.results or n.label in self.inputs
+
+    def get_result(self, n):
+        """Get a node's output in this context."""
+        if n in self.results:
+            return self.results[n]
+        return self.inputs[n.label]
+
+    def set_result(self, n, data):
+        """Store a node's output in this context."""
+        self.results[n] = data
+
+    def is_clean(self, n):
+        """Check that neither a node nor anything upstream of it has
+        overridden params or supplied data, so that the script's own
+        cache is valid for it."""
+        clean = self._clean.get(n)
+        if clean is None:
+            clean = self._clean[n] = all(m.label not in self.params \
+                        and m.label not in self.inputs for m in n.members()) \
+                    and all(self.is_clean(i) for i in n.inputs() \
+                        if i is not None)
+        return clean
+
+    def clear(self):
+        """Drop all results, keeping params and inputs."""
+        self.results = {}
+        self._params = {}
+        self._inputdata = {}
+        self._clean = {}
+
+    def __repr__(self):
+        return "<%s: %d results>" % (self.__class__.__name__, len(self.results))
@@ -51,6 +51,7 @@ class makenode(object):
             outtype = self.outtype,
             description = textwrap.dedent(doc),
             name = "%s.%s" % (ns, clsname),
+            fusable = True,
         )
         clsdict.update(self.kwargs)
         return type(clsname + "Node", (node.Node,), clsdict)()
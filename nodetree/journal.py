@@ -0,0 +1,117 @@
+"""
+Run journal for checkpointing and resuming script evaluations.
+"""
+
+from __future__ import absolute_import
+
+import os
+import json
+import pickle
+
+from . import utils, writable_node
+
+
+class RunJournal(object):
+    """
+    Records nodes completed during a script run and persists their
+    outputs, so that a restarted run of the same script can resume
+    from the last completed frontier.  Each entry is keyed to the
+    node's hash_digest, so a checkpoint goes stale as soon as the
+    params of the node, or of anything upstream of it, change.
+    """
+    filename = "journal"
+    extension = ".pickle"
+
+    def __init__(self, path, logger=None):
+        self.path = path
+        self.logger = logger
+        self._entries = {}
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self._load()
+
+    def _load(self):
+        """Read existing entries, ignoring a line left half-written
+        by a crash."""
+        journal = os.path.join(self.path, self.filename)
+        if not os.path.exists(journal):
+            return
+        with open(journal, "r") as handle:
+            for line in handle:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                self._entries[entry["label"]] = (entry["digest"], entry["file"])
+
+    def _debug(self, msg, *args):
+        if self.logger is not None:
+            self.logger.debug(msg, *args)
+
+    def get_file_name(self, n, digest):
+        """Name of the file holding a node's checkpointed output."""
+        ext = n.extension if isinstance(n, writable_node.WritableNodeMixin) \
+                else self.extension
+        return "%s%s" % (digest, ext)
+
+    def is_complete(self, n, digest=None):
+        """Check if a node has a checkpoint matching its current state.
+        `digest`, if given, is the node's already-computed hash_digest."""
+        entry = self._entries.get(n.label)
+        if entry is None:
+            return False
+        if entry[0] != (digest or utils.hash_digest(n)):
+            self._debug("Stale checkpoint for %s", n)
+            return False
+        return os.path.exists(os.path.join(self.path, entry[1]))
+
+    def restore(self, n, digest=None):
+        """Load a node's checkpointed output into its cache.  Returns
+        False if there is no valid checkpoint."""
+        if not self.is_complete(n, digest):
+            return False
+        with open(os.path.join(self.path, self._entries[n.label][1]), "rb") as handle:
+            if isinstance(n, writable_node.WritableNodeMixin):
+                data = n.reader(handle)
+            else:
+                data = pickle.load(handle)
+        self._debug("Restored %s from checkpoint", n)
+        n.set_cache(data)
+        return True
+
+    def record(self, n, data, digest=None):
+        """Persist a node's output and mark it complete.  The output
+        is written before the journal entry, so a crash at any point
+        leaves no entry pointing at a partial file."""
+        digest = digest or utils.hash_digest(n)
+        fname = self.get_file_name(n, digest)
+        path = os.path.join(self.path, fname)
+        with open(path + ".tmp", "wb") as handle:
+            if isinstance(n, writable_node.WritableNodeMixin):
+                n.writer(handle, data)
+            else:
+                pickle.dump(data, handle, pickle.HIGHEST_PROTOCOL)
+        os.rename(path + ".tmp", path)
+        old = self._entries.get(n.label)
+        self._entries[n.label] = (digest, fname)
+        with open(os.path.join(self.path, self.filename), "a") as handle:
+            handle.write(json.dumps(dict(label=n.label, digest=digest,
+                    file=fname)) + "\n")
+            handle.flush()
+            os.fsync(handle.fileno())
+        if old is not None and old[1] != fname \
+                and old[1] not in [e[1] for e in self._entries.values()]:
+            os.unlink(os.path.join(self.path, old[1]))
+        self._debug("Checkpointed %s", n)
+
+    def clear(self):
+        """Remove all checkpoints."""
+        for digest, fname in self._entries.values():
+            if os.path.exists(os.path.join(self.path, fname)):
+                os.unlink(os.path.join(self.path, fname))
+        if os.path.exists(os.path.join(self.path, self.filename)):
+            os.unlink(os.path.join(self.path, self.filename))
+        self._entries = {}
+
+    def __repr__(self):
+        return "<%s: %s>" % (self.__class__.__name__, self.path)
@@ -5,12 +5,13 @@ from __future__ import absolute_import
 import sys
 import textwrap
 import logging
+import threading
 FORMAT = '%(levelname)-5s %(module)s: %(message)s'
 logging.basicConfig(format=FORMAT)
 LOGGER = logging.getLogger("Node")
 LOGGER.setLevel(logging.INFO)
 
-from . import cache, registry, exceptions
+from . import cache, registry, exceptions, context
 
 
 def noop_abort_func(*args):
@@ -76,6 +77,8 @@ class Node(object):
     intypes = [object]
     outtype = object
     parameters = []
+    fusable = False
+    proxy = False
 
     def __init__(self, label=None, abort_func=None, 
                 cacher=None,
@@ -94,9 +97,34 @@ class Node(object):
         self._parents = []
         self._inputs = [None for n in range(self.arity)]
         self._inputdata = [None for n in range(self.arity)]
+        self._lock = threading.RLock()
         self.logger.debug("Initialised %s with cacher: %s" % (self.label, self._cacher))
         self.ignored = ignored
 
+    def _get_params(self):
+        ctx = context.current()
+        if ctx is None:
+            return self._node_params
+        return ctx.get_params(self)
+
+    def _set_params(self, params):
+        self._node_params = params
+
+    _params = property(_get_params, _set_params,
+            doc="Params, or those of the active evaluation context.")
+
+    def _get_inputdata(self):
+        ctx = context.current()
+        if ctx is None:
+            return self._node_inputdata
+        return ctx.get_inputdata(self)
+
+    def _set_inputdata(self, data):
+        self._node_inputdata = data
+
+    _inputdata = property(_get_inputdata, _set_inputdata,
+            doc="Input data, or that of the active evaluation context.")
+
     def set_param(self, param, name):
         """Set a parameter."""
         self._params[param] = name
@@ -106,6 +134,12 @@ class Node(object):
         """Set a parameter internally."""
         pass
 
+    def has_param_state(self):
+        """Check if the node keeps parameter state outside `_params`,
+        by overriding `_set_p`.  Such nodes are locked while they
+        process under an evaluation context."""
+        return type(self)._set_p.im_func is not Node._set_p.im_func
+
     def process(self):
         """Perform actual processing."""
         return
@@ -117,10 +151,20 @@ class Node(object):
         if not n in self._parents:
             self._parents.append(n)
 
+    def remove_parent(self, n):
+        """Remove a parent node."""
+        if n in self._parents:
+            self._parents.remove(n)
+
     def has_parents(self):
         """Check if the node is a terminal node
-        or if there's a tree further down."""
-        return bool(len(self._parents))
+        or if there's a tree further down.  A proxy node
+        counts as a parent only if it has parents itself."""
+        return any(not p.proxy or p.has_parents() for p in self._parents)
+
+    def members(self):
+        """Get the nodes in the tree this node stands for."""
+        return [self]
 
     def input(self, num):
         """Get an input by index."""
@@ -136,9 +180,12 @@ class Node(object):
         """Set an input by index."""
         if num > len(self._inputs) - 1:
             raise exceptions.InputOutOfRange("Input '%d'" % num, self)
+        old = self._inputs[num]
         if n is not None:
             n.add_parent(self)
         self._inputs[num] = n
+        if old is not None and old is not n and old not in self._inputs:
+            old.remove_parent(self)
 
     def mark_dirty(self):
         """Tell the node it needs to reevaluate."""
@@ -147,6 +194,12 @@ class Node(object):
             parent.mark_dirty()
         self._cacher.clear_cache(self)
 
+    def allocate_output(self, shape, dtype):
+        """Get an empty array to build the node's output in.  Cachers
+        that keep outputs in their own storage hand out an array in
+        that storage, so returning it from `process` costs no copy."""
+        return self._cacher.allocate(self, shape, dtype)
+
     def set_cache(self, cache):
         """Set the cache on a node, preventing it
         from eval'ing its inputs."""
@@ -252,6 +305,9 @@ class Node(object):
 
     def eval(self):
         """Eval the node."""
+        ctx = context.current()
+        if ctx is not None:
+            return self.context_eval(ctx)
         if self.ignored:
             self.logger.debug("Ignoring node: %s", self)
             return self.null_data()
@@ -267,6 +323,41 @@ class Node(object):
         self.logger.debug("Evaluating '%s' Node", self)
         data = self.early_eval()
         self._cacher.set_cache(self, data)
+        # return what the cacher holds, which may be a view of spilled
+        # or shared data, so the original can be freed; a cacher need
+        # not keep everything, though
+        if self._cacher.has_cache(self):
+            return self._cacher.get_cache(self)
+        return data
+
+    def context_eval(self, ctx):
+        """Eval the node within an evaluation context.  Results are
+        stored on the context, and the node's own cache is only read,
+        and only if the context leaves the node unchanged."""
+        if ctx.has_result(self):
+            return ctx.get_result(self)
+        if self.ignored:
+            self.logger.debug("Ignoring node: %s", self)
+            return self.null_data()
+        self.validate()
+        if ctx.shared_cache and ctx.is_clean(self) \
+                and self._cacher.has_cache(self):
+            self.logger.debug("%s returning shared cached input", self)
+            data = self._cacher.get_cache(self)
+        else:
+            self.eval_inputs()
+            self.logger.debug("Evaluating '%s' Node in %s", self, ctx)
+            locked = self.has_param_state()
+            if locked:
+                self._lock.acquire()
+            try:
+                for p, v in self._params.iteritems():
+                    self._set_p(p, v)
+                data = self.early_eval()
+            finally:
+                if locked:
+                    self._lock.release()
+        ctx.set_result(self, data)
         return data
 
     def __repr__(self):
@@ -276,6 +367,91 @@ class Node(object):
         return "%s<%s>" % (self.label, self.name)
 
 
+class FusedNode(Node):
+    """A linear chain of single-input nodes evaluated as one,
+    calling each node's process function back-to-back.  The
+    fused node takes the label, cacher and hash_value of the
+    last node in the chain, so it caches only at the chain's
+    boundary and is interchangeable with it."""
+    autoregister = False
+    name = "node.FusedNode"
+    description = "Fused chain of nodes"
+    arity = 1
+    passthrough = 0
+    proxy = True
+
+    def __init__(self, chain):
+        tail = chain[-1]
+        super(FusedNode, self).__init__(label=tail.label,
+                abort_func=tail.abort_func, cacher=tail._cacher,
+                progress_func=tail.progress_func, logger=tail.logger)
+        self.chain = list(chain)
+        self.intypes = chain[0].intypes
+        self.outtype = tail.outtype
+        self.set_input(0, chain[0].input(0))
+        for n in self.chain:
+            n.add_parent(self)
+
+    def validate(self):
+        """Check the chain's input and validate each active member,
+        including the types passed between members."""
+        self.validate_inputs()
+        for n in self.chain:
+            if not n.ignored:
+                n.validate()
+
+    def early_eval(self):
+        """Run each member's process function in turn, locking
+        members that keep parameter state.  Ignored members pass
+        their input straight through.  Errors are attributed to the
+        member that raised them."""
+        data = self.get_input_data(0)
+        for n in self.chain:
+            if n.ignored:
+                n.logger.debug("Ignoring node: %s", n)
+                continue
+            locked = n.has_param_state()
+            if locked:
+                n._lock.acquire()
+            try:
+                for p, v in n._params.iteritems():
+                    n._set_p(p, v)
+                data = n.process(data)
+            except Exception, err:
+                if getattr(err, "node", None) is None:
+                    err.node = n
+                n.logger.error("Error evaluating %s in %r", n, self)
+                raise
+            finally:
+                if locked:
+                    n._lock.release()
+        return data
+
+    def context_eval(self, ctx):
+        """Eval the chain within an evaluation context.  If the context
+        supplies data for, or overrides the params of, any member, the
+        members are evaluated one by one instead, so that each reads
+        its own state from the context."""
+        if not ctx.has_result(self) and any(m.label in ctx.inputs \
+                or m.label in ctx.params for m in self.chain):
+            data = self.chain[-1].context_eval(ctx)
+            ctx.set_result(self, data)
+            return data
+        return super(FusedNode, self).context_eval(ctx)
+
+    def members(self):
+        """Get the nodes of the chain."""
+        return list(self.chain)
+
+    def hash_value(self):
+        """Get the hash_value of the last node in the chain."""
+        return self.chain[-1].hash_value()
+
+    def __repr__(self):
+        return "<%s: %s>" % (self.__class__.__name__,
+                " -> ".join(str(n.label) for n in self.chain))
+
+
 
 
 
@@ -2,7 +2,87 @@
 
 from __future__ import absolute_import
 
-from . import node, registry, exceptions
+import itertools
+import multiprocessing
+
+from . import node, registry, exceptions, binary, utils, transport
+
+
+def _node_names(script):
+    """Node labels in a serialized script, skipping meta entries."""
+    return set(k for k in script if not k.startswith("__"))
+
+
+def _node_meta(n):
+    """Meta entries of a serialized node."""
+    return dict((k, v) for k, v in n.iteritems() if k.startswith("__"))
+
+
+_sweep_script = None
+_sweep_memo = None
+
+
+def _sweep_init(script, memo):
+    """Give a forked sweep worker the script it runs on and the
+    outputs already computed for it."""
+    global _sweep_script, _sweep_memo
+    _sweep_script, _sweep_memo = script, memo
+
+
+def _sweep_group(args):
+    """Run part of a sweep in a worker process.  Outputs that can go
+    through shared memory are returned as segment handles, disowned
+    for the parent to adopt."""
+    sweep, labels = args
+    varied, axes, upstream, memoized = _sweep_script._sweep_plan(sweep)
+    shared = transport.SharedMemoryTransport()
+    results = []
+    for combo, outputs in _sweep_script._sweep_combinations(varied, axes,
+            memoized, labels, dict(_sweep_memo)):
+        results.append((combo, dict((l, shared.disown(shared.put(data))) \
+                for l, data in outputs.iteritems())))
+    return results
+
+
+class ScriptDiff(object):
+    """Differences between two serialized scripts.  Nodes whose type
+    changes are treated as removed and re-added."""
+    def __init__(self, old, new):
+        oldnames, newnames = _node_names(old), _node_names(new)
+        common = oldnames & newnames
+        retyped = set(n for n in common if old[n]["type"] != new[n]["type"])
+        self.new = new
+        self.removed = (oldnames - newnames) | retyped
+        self.added = (newnames - oldnames) | retyped
+        self.params, self.unset, self.inputs = {}, {}, {}
+        self.ignored, self.meta = {}, {}
+        for name in common - retyped:
+            o, n = old[name], new[name]
+            oldparams, newparams = dict(o["params"]), dict(n["params"])
+            changed = dict((p, v) for p, v in newparams.iteritems() \
+                    if p not in oldparams or oldparams[p] != v)
+            if changed:
+                self.params[name] = changed
+            unset = [p for p in oldparams if p not in newparams]
+            if unset:
+                self.unset[name] = unset
+            if list(o["inputs"]) != list(n["inputs"]):
+                self.inputs[name] = n["inputs"]
+            if o.get("ignored", False) != n.get("ignored", False):
+                self.ignored[name] = n.get("ignored", False)
+            if _node_meta(o) != _node_meta(n):
+                self.meta[name] = _node_meta(n)
+
+    def is_empty(self):
+        """Check if the scripts are identical."""
+        return not (self.removed or self.added or self.params \
+                or self.unset or self.inputs or self.ignored or self.meta)
+
+    def __repr__(self):
+        return "<%s: +%d -%d ~%d>" % (self.__class__.__name__,
+                len(self.added), len(self.removed),
+                len(set(self.params) | set(self.unset) | set(self.inputs) \
+                    | set(self.ignored)))
 
 
 class Script(object):
@@ -15,6 +95,7 @@ class Script(object):
         self._tree = {}
         self._meta = []
         self._nodemeta = {}
+        self._fused = {}
         self._build_tree(script)
 
     def _build_tree(self, script):
@@ -34,6 +115,28 @@ class Script(object):
             for i in range(len(n["inputs"])):
                 self._tree[name].set_input(i, self._tree.get(n["inputs"][i]))
 
+    @classmethod
+    def from_binary(cls, data, nodekwargs=None):
+        """Build a script from its binary serialization."""
+        script = cls({}, nodekwargs=nodekwargs)
+        script._build_tree_binary(data)
+        return script
+
+    def _build_tree_binary(self, data):
+        """Wire up nodes from a binary script in a single pass.  Nodes
+        arrive in dependency order, so inputs always exist already."""
+        reader = binary.Reader(data)
+        self._meta.extend(reader.meta)
+        for name, nodetype, inputs, params, extras in reader.nodes():
+            n = self._tree[name] = self.new_node(nodetype, name, params)
+            for attr, val in extras:
+                if attr.startswith("__"):
+                    self._nodemeta[name] = (attr, val)
+                elif attr == "ignored":
+                    n.ignored = val
+            for i in range(len(inputs)):
+                n.set_input(i, self._tree.get(inputs[i]))
+
     def add_node(self, type, label, params):
         """Add a node of the given type, with the given label."""
         self._tree[label] = self.new_node(type, label, params)        
@@ -54,6 +157,133 @@ class Script(object):
         del self._tree[old.label]
         self._tree[new.label] = new                    
 
+    def apply_diff(self, old, new=None):
+        """Bring the tree in line with a new serialization, given either
+        a ScriptDiff or the old and new serialized scripts.  Nodes are
+        updated in place, so only those whose params or inputs changed,
+        and those downstream of them, lose their cached data."""
+        diff = old if isinstance(old, ScriptDiff) else ScriptDiff(old, new)
+        changed = diff.removed | set(diff.inputs) | set(diff.ignored)
+        for f in self._fused.values():
+            if any(m.label in changed for m in f.members()):
+                self._detach_fused(f)
+        for name in diff.removed:
+            n = self._tree.pop(name)
+            self._nodemeta.pop(name, None)
+            for i in range(n.arity):
+                n.set_input(i, None)
+            n._cacher.clear_cache(n)
+        for name in diff.added:
+            n = diff.new[name]
+            self._tree[name] = self.new_node(n["type"], name, n["params"])
+            self._tree[name].ignored = n.get("ignored", False)
+            self.set_node_meta(name, _node_meta(n))
+        for name, params in diff.unset.iteritems():
+            n = self._tree[name]
+            for p in params:
+                n._params.pop(p, None)
+            n.mark_dirty()
+        for name, params in diff.params.iteritems():
+            for p, v in params.iteritems():
+                self._tree[name].set_param(p, v)
+        for name, ignored in diff.ignored.iteritems():
+            self._tree[name].ignored = ignored
+            self._tree[name].mark_dirty()
+        for name, meta in diff.meta.iteritems():
+            self.set_node_meta(name, meta)
+        rewire = set(diff.inputs) | diff.added
+        for name, n in self._tree.iteritems():
+            if any(i is not None \
+                    and self._tree.get(i.label) is not i.members()[-1] \
+                    for i in n.inputs()):
+                rewire.add(name)
+        for name in rewire:
+            n = self._tree[name]
+            inputs = diff.new[name]["inputs"]
+            for i in range(len(inputs)):
+                n.set_input(i, self._tree.get(inputs[i]))
+            n.mark_dirty()
+        return diff
+
+    def set_node_meta(self, name, meta):
+        """Replace the meta entry stored for a node."""
+        self._nodemeta.pop(name, None)
+        for attr, val in meta.iteritems():
+            self._nodemeta[name] = (attr, val)
+
+    def fuse(self, keep=None):
+        """Collapse maximal chains of fusable single-input nodes,
+        where each node but the last feeds only the next, into
+        FusedNodes.  Consumers of a chain's last node are rewired
+        to the fused node, and `eval` uses the fused node in place
+        of a last node it is asked for; the tree itself is left
+        unchanged, so serialization is unaffected.  Nodes listed in
+        `keep` only end chains, so their outputs are still cached.
+        Returns the fused nodes."""
+        keep = set(keep or [])
+        fused = set()
+        for f in self._fused.itervalues():
+            fused.update(f.members())
+        consumers = {}
+        for n in self._tree.itervalues():
+            for i in n.inputs():
+                if i is not None:
+                    consumers.setdefault(i, []).append(n)
+
+        def fusable(n):
+            return n.fusable and n.arity == 1 and not n.ignored \
+                    and not n.proxy and n not in fused
+
+        def next_link(n):
+            if not fusable(n) or n.label in keep:
+                return None
+            cons = consumers.get(n, [])
+            if len(cons) == 1 and fusable(cons[0]):
+                return cons[0]
+
+        created = []
+        for n in self._tree.values():
+            if not fusable(n) or (n.input(0) is not None \
+                    and next_link(n.input(0)) is n):
+                continue
+            chain = [n]
+            while next_link(chain[-1]) is not None:
+                chain.append(next_link(chain[-1]))
+            if len(chain) < 2:
+                continue
+            f = node.FusedNode(chain)
+            for c in consumers.get(chain[-1], []):
+                for i in range(c.arity):
+                    if c.input(i) is chain[-1]:
+                        c.set_input(i, f)
+            self._fused[chain[-1]] = f
+            created.append(f)
+        return created
+
+    def unfuse(self):
+        """Detach every fused node, rewiring consumers back to the
+        original chains."""
+        for f in self._fused.values():
+            self._detach_fused(f)
+
+    def _detach_fused(self, f):
+        """Rewire a fused node's consumers to its last node and
+        disconnect it from the chain."""
+        tail = f.members()[-1]
+        for n in self._tree.itervalues():
+            for i in range(n.arity):
+                if n.input(i) is f:
+                    n.set_input(i, tail)
+        f.set_input(0, None)
+        for member in f.members():
+            member.remove_parent(f)
+        self._fused.pop(tail, None)
+
+    def stand_in(self, n):
+        """Get the node evaluated in place of a node: its fused
+        chain, if it ends one, or the node itself."""
+        return self._fused.get(n, n)
+
     def get_node(self, name):
         """Find a node in the tree."""
         return self._tree.get(name)
@@ -78,6 +308,205 @@ class Script(object):
         return [n for n in self._tree.itervalues() \
                 if not n.has_parents()]
 
+    def active_inputs(self, n):
+        """Get the distinct active nodes a node takes data from,
+        looking through any ignored inputs."""
+        active = []
+        for i in n.inputs():
+            if i is not None and i.first_active() not in active:
+                active.append(i.first_active())
+        return active
+
+    def schedule(self, nodes, stop=None):
+        """Order the active nodes needed to evaluate the given nodes
+        so that each comes after all of its inputs.  Nodes for which
+        `stop` returns True, by default those that are already cached,
+        are included, but not their inputs."""
+        if stop is None:
+            stop = lambda n: n._cacher.has_cache(n)
+        def visit(n):
+            seen.add(n)
+            return (n, None if stop(n) else iter(self.active_inputs(n)))
+        order, seen = [], set()
+        for root in nodes:
+            if root.first_active() in seen:
+                continue
+            stack = [visit(root.first_active())]
+            while stack:
+                n, inputs = stack[-1]
+                for i in inputs or ():
+                    if i not in seen:
+                        stack.append(visit(i))
+                        break
+                else:
+                    stack.pop()
+                    order.append(n)
+        return order
+
+    def eval(self, labels=None, frugal=False, keep=None, journal=None,
+                context=None):
+        """Evaluate the given nodes, or all terminals, returning a
+        dict of label -> output.  Inputs are evaluated first, in
+        dependency order.
+
+        In frugal mode, each intermediate output is dropped, from
+        both its cache and its consumers' input data, as soon as
+        all of its consumers have run.  Only the requested outputs,
+        those listed in `keep`, and those already cached before the
+        run are left in the cache.
+
+        If a RunJournal is given, nodes with a valid checkpoint are
+        restored rather than evaluated, and every node that is
+        evaluated is checkpointed as it completes.
+
+        If an EvalContext is given, all per-run state is kept on it and
+        the script's nodes and caches are left untouched, so the same
+        script can be evaluated from many threads at once.  Frugal mode,
+        `keep` and journalling apply to the script's caches, so cannot
+        be combined with a context."""
+        if context is not None and (frugal or keep or journal is not None):
+            raise exceptions.ScriptError("frugal, keep and journal cannot "
+                    "be used with an evaluation context")
+        outputs = [self._tree[l] for l in labels] if labels is not None \
+                else self.get_terminals()
+        outputs = [self.stand_in(n) for n in outputs]
+        if context is not None:
+            with context:
+                for n in self.schedule(outputs, context.has_result):
+                    n.eval()
+                return dict((n.label, n.eval()) for n in outputs)
+        cached, restored, digests = set(), set(), {}
+        def stop(n):
+            if n._cacher.has_cache(n):
+                cached.add(n)
+            elif journal is not None \
+                    and journal.restore(n, utils.hash_digest(n, digests)):
+                restored.add(n)
+            return n in cached or n in restored
+        order = self.schedule(outputs, stop)
+        kept = set(n.first_active() for n in outputs)
+        kept.update(self.stand_in(self._tree[l]).first_active() \
+                for l in keep or [])
+        kept.update(cached)
+        refs = dict((n, 0) for n in order)
+        deps = {}
+        for n in order:
+            deps[n] = [i for i in self.active_inputs(n) if i in refs]
+            for i in deps[n]:
+                refs[i] += 1
+        for n in order:
+            data = n.eval()
+            if journal is not None and data is not None \
+                    and n not in cached and n not in restored:
+                journal.record(n, data, utils.hash_digest(n, digests))
+            if not frugal:
+                continue
+            n._inputdata = [None for i in range(n.arity)]
+            for i in deps[n]:
+                refs[i] -= 1
+                if refs[i] == 0 and i not in kept:
+                    i.logger.debug("Freeing output of %s", i)
+                    i._cacher.clear_cache(i)
+        return dict((n.label, n.eval()) for n in outputs)
+
+    def sweep(self, sweep, labels=None, processes=None):
+        """Evaluate the script for every combination of the given
+        parameter values, yielding (combination, outputs) pairs, where
+        `sweep` and each combination are dicts of the form
+        {label: {param: value(s)}}, and outputs is as for `eval`.
+
+        Combinations are ordered so that params of upstream nodes vary
+        least often, and the outputs of nodes that depend on only some
+        of the varied params are remembered by state, so each distinct
+        upstream state is computed once.  With `processes`, groups of
+        combinations sharing the same values for the most upstream node
+        are run in a pool of worker processes forked from this one, each
+        on its own copy of the script.  Outputs that do not depend on
+        that node are computed once, before the pool starts, and shared
+        with every worker; outputs that support the buffer protocol come
+        back as views of shared segments rather than pickled copies.
+        Node params are restored afterwards."""
+        varied, axes, upstream, memoized = self._sweep_plan(sweep)
+        if processes is None or not varied:
+            for item in self._sweep_combinations(varied, axes, memoized,
+                    labels, {}):
+                yield item
+            return
+        independent = [n for n in memoized if varied[0] not in upstream[n]]
+        memo = {}
+        if independent:
+            for item in self._sweep_combinations(varied[1:], axes[1:],
+                    independent, [n.label for n in independent], memo):
+                pass
+        groups = []
+        for outer in axes[0]:
+            group = dict(sweep)
+            group[varied[0].label] = dict((p, [v]) for p, v \
+                    in outer.iteritems())
+            groups.append((group, labels))
+        shared = transport.SharedMemoryTransport()
+        pool = multiprocessing.Pool(processes, _sweep_init, (self, memo))
+        try:
+            for results in pool.imap(_sweep_group, groups):
+                for combo, outputs in results:
+                    for label, handle in outputs.iteritems():
+                        outputs[label] = shared.get(shared.adopt(handle))
+                        # views outlive the segment's removal
+                        shared.release(handle)
+                    yield combo, outputs
+        finally:
+            pool.terminate()
+            shared.clear()
+
+    def _sweep_plan(self, sweep):
+        """Work out the varied nodes of a sweep, most upstream first,
+        the param combinations for each, the varied nodes upstream of
+        every node, and the nodes whose outputs are worth remembering."""
+        position = dict((n, i) for i, n in enumerate(
+                self.schedule(self._tree.values(), lambda n: False)))
+        varied = sorted((self._tree[l] for l in sweep), key=position.get)
+        axes = []
+        for n in varied:
+            params = sorted(sweep[n.label])
+            axes.append([dict(zip(params, values)) for values in \
+                    itertools.product(*[sweep[n.label][p] for p in params])])
+        upstream = {}
+        for n in sorted(position, key=position.get):
+            upstream[n] = set([n]) if n in varied else set()
+            for i in self.active_inputs(n):
+                upstream[n].update(upstream.get(i, ()))
+        memoized = [n for n, up in upstream.iteritems() \
+                if up and len(up) < len(varied)]
+        return varied, axes, upstream, memoized
+
+    def _sweep_combinations(self, varied, axes, memoized, labels, memo):
+        """Evaluate every combination of params in turn, remembering
+        the outputs of `memoized` nodes in `memo` by state."""
+        original = [(n, dict(n._params)) for n in varied]
+        try:
+            for values in itertools.product(*axes):
+                for n, params in zip(varied, values):
+                    for p, v in params.iteritems():
+                        if n._params.get(p) != v:
+                            n.set_param(p, v)
+                known = {}
+                digests = dict((n, utils.hash_digest(n, known)) \
+                        for n in memoized)
+                for n in memoized:
+                    if not n._cacher.has_cache(n) and digests[n] in memo:
+                        n.set_cache(memo[digests[n]])
+                outputs = self.eval(labels)
+                for n in memoized:
+                    if n._cacher.has_cache(n):
+                        memo[digests[n]] = n._cacher.get_cache(n)
+                yield dict((n.label, dict(params)) for n, params \
+                        in zip(varied, values)), outputs
+        finally:
+            for n, params in original:
+                if n._params != params:
+                    n._params = params
+                    n.mark_dirty()
+
     def validate(self):
         """Call 'validate' on all nodes."""
         errors = {}
@@ -103,4 +532,6 @@ class Script(object):
                 out[name][meta[0]] = meta[1]
         return out            
 
-
+    def serialize_binary(self):
+        """Serialize the script to the compact binary format."""
+        return binary.dumps(self.serialize())
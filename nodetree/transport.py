@@ -0,0 +1,219 @@
+"""
+Shared-memory transport for large node outputs.
+
+Buffer-protocol data (NumPy arrays, bytearrays, memoryviews and, on
+Python 3, bytes) is placed in memory-mapped segments and referred to
+by small, picklable handles.  A handle can be passed to another process, which maps the
+same segment instead of receiving a pickled copy of the data.
+
+`put` copies existing data into a segment once; to avoid even that,
+a producer can `allocate` a segment and build its data in place.
+"""
+
+from __future__ import absolute_import
+
+import os
+import mmap
+import uuid
+import tempfile
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+SHM_DIR = "/dev/shm"
+
+
+def default_directory():
+    """Directory in which segments are created.  On Linux this is
+    the RAM-backed /dev/shm, otherwise the system temp dir."""
+    if os.path.isdir(SHM_DIR):
+        return SHM_DIR
+    return tempfile.gettempdir()
+
+
+def buffer_view(mm, size):
+    """Return a zero-copy view of the first `size` bytes of a map."""
+    try:
+        return memoryview(mm)[:size]
+    except TypeError:
+        # Python 2's mmap only exposes the old buffer interface.
+        return buffer(mm, 0, size)
+
+
+class SegmentHandle(object):
+    """Picklable reference to data held in a shared segment."""
+    def __init__(self, path, size, kind="buffer", dtype=None, shape=None):
+        self.path = path
+        self.size = size
+        self.kind = kind
+        self.dtype = dtype
+        self.shape = shape
+
+    def __eq__(self, other):
+        return isinstance(other, SegmentHandle) and self.path == other.path
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.path)
+
+    def __repr__(self):
+        return "<%s: %s (%d bytes)>" % (self.__class__.__name__,
+                os.path.basename(self.path), self.size)
+
+
+class SharedMemoryTransport(object):
+    """Moves buffer-protocol data through shared segments.  Segments
+    created by a transport are owned by it and removed on `release`
+    or `clear`; segments attached from a handle created elsewhere are
+    only unmapped.  Ownership stays with the creating process, so a
+    forked copy of a transport never removes its parent's segments."""
+    prefix = "nodetree-"
+
+    def __init__(self, directory=None, logger=None):
+        self.directory = directory if directory is not None \
+                else default_directory()
+        self.logger = logger
+        self._maps = {}
+        self._owned = {}
+
+    def is_transportable(self, data):
+        """Check if data can be placed in a segment.  On Python 2,
+        where `bytes` is `str`, strings are left alone, since their
+        consumers expect a string rather than a read-only buffer."""
+        if numpy is not None and isinstance(data, numpy.ndarray):
+            return not data.dtype.hasobject
+        if isinstance(data, (bytearray, memoryview)):
+            return True
+        return bytes is not str and isinstance(data, bytes)
+
+    def nbytes(self, data):
+        """Size in bytes of transportable data, or None."""
+        if not self.is_transportable(data):
+            return None
+        if numpy is not None and isinstance(data, numpy.ndarray):
+            return data.nbytes
+        view = memoryview(data)
+        return view.itemsize * _count(view.shape)
+
+    def allocate(self, size, kind="buffer", dtype=None, shape=None):
+        """Create an empty segment of the given size and return
+        its handle.  Producers can fill the view returned by `get`
+        directly, avoiding any copy at all."""
+        path = os.path.join(self.directory,
+                "%s%s" % (self.prefix, uuid.uuid4().hex))
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o600)
+        try:
+            # zero-length maps are not allowed
+            os.ftruncate(fd, max(size, 1))
+            mm = mmap.mmap(fd, max(size, 1))
+        finally:
+            os.close(fd)
+        self._maps[path] = mm
+        self._owned[path] = os.getpid()
+        if self.logger is not None:
+            self.logger.debug("Allocated segment %s: %d bytes", path, size)
+        return SegmentHandle(path, size, kind, dtype, shape)
+
+    def put(self, data):
+        """Copy data into a new segment and return its handle.
+        Data that does not support the buffer protocol is returned
+        unchanged."""
+        if not self.is_transportable(data):
+            return data
+        if numpy is not None and isinstance(data, numpy.ndarray):
+            handle = self.allocate(data.nbytes, "ndarray",
+                    data.dtype.str, data.shape)
+            self.get(handle)[...] = data
+            return handle
+        view = memoryview(data)
+        size = self.nbytes(data)
+        handle = self.allocate(size)
+        mm = self._maps[handle.path]
+        try:
+            mm[0:size] = view
+        except (TypeError, IndexError, ValueError, BufferError):
+            mm[0:size] = view.tobytes()
+        return handle
+
+    def get(self, handle):
+        """Return a zero-copy view of the data a handle refers
+        to, mapping the segment if necessary.  Anything that is
+        not a handle is returned unchanged."""
+        if not isinstance(handle, SegmentHandle):
+            return handle
+        mm = self._maps.get(handle.path)
+        if mm is None:
+            mm = self._attach(handle)
+        if handle.kind == "ndarray":
+            if numpy is None:
+                raise ImportError("numpy is required to read "
+                        "array segment: %r" % handle)
+            return numpy.ndarray(handle.shape, dtype=numpy.dtype(handle.dtype),
+                    buffer=mm)
+        return buffer_view(mm, handle.size)
+
+    def release(self, handle):
+        """Drop a segment.  Views already handed out remain valid
+        until they are themselves garbage collected."""
+        if not isinstance(handle, SegmentHandle):
+            return
+        self._maps.pop(handle.path, None)
+        if self._owned.pop(handle.path, None) == os.getpid():
+            try:
+                os.unlink(handle.path)
+            except OSError:
+                pass
+            if self.logger is not None:
+                self.logger.debug("Released segment %s", handle.path)
+
+    def disown(self, handle):
+        """Unmap a segment without removing it, leaving it to be
+        `adopt`ed by another transport, usually in another process."""
+        if isinstance(handle, SegmentHandle):
+            self._maps.pop(handle.path, None)
+            self._owned.pop(handle.path, None)
+        return handle
+
+    def adopt(self, handle):
+        """Take ownership of a segment disowned elsewhere, so that
+        it is removed when released."""
+        if isinstance(handle, SegmentHandle):
+            self._owned[handle.path] = os.getpid()
+        return handle
+
+    def clear(self):
+        """Release every segment held by the transport."""
+        for path in set(self._maps) | set(self._owned):
+            self.release(SegmentHandle(path, 0))
+
+    def _attach(self, handle):
+        """Map a segment created by another transport."""
+        fd = os.open(handle.path, os.O_RDWR)
+        try:
+            mm = mmap.mmap(fd, max(handle.size, 1))
+        finally:
+            os.close(fd)
+        self._maps[handle.path] = mm
+        return mm
+
+    def __del__(self):
+        try:
+            self.clear()
+        except Exception:
+            pass
+
+    def __repr__(self):
+        return "<%s: %s>" % (self.__class__.__name__, self.directory)
+
+
+def _count(shape):
+    """Number of items in a buffer of the given shape."""
+    num = 1
+    for dim in shape or ():
+        num *= dim
+    return num
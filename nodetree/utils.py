@@ -3,6 +3,7 @@
 import json
 import node
 import types
+import hashlib
 
 
 
@@ -24,6 +25,47 @@ class NodeEncoder(json.JSONEncoder):
         return super(NodeEncoder, self).default(n)            
 
 
+def _digest_source(n):
+    """The node whose state stands for that of `n`: the last node of
+    a fused chain, or the passthrough input of an ignored node."""
+    if n.proxy:
+        return n.members()[-1]
+    if n.arity > 0 and n.ignored and n.input(n.passthrough) is not None:
+        return n.input(n.passthrough)
+    return n
+
+
+def hash_digest(n, memo=None):
+    """Get a stable hex digest of a node's state: the sha1 of its type,
+    its sorted params and the digests of its inputs.  Digests are built
+    bottom-up without recursion; pass the same `memo` dict to every
+    call in a run to compute each node's digest only once."""
+    memo = memo if memo is not None else {}
+    stack = [n]
+    while stack:
+        cur = stack[-1]
+        if cur in memo:
+            stack.pop()
+            continue
+        source = _digest_source(cur)
+        deps = [source] if source is not cur \
+                else [i for i in cur.inputs() if i is not None]
+        missing = [d for d in deps if d not in memo]
+        if missing:
+            stack.extend(missing)
+            continue
+        stack.pop()
+        if source is not cur:
+            memo[cur] = memo[source]
+            continue
+        sha = hashlib.sha1(cur.name.encode("utf-8"))
+        sha.update(json.dumps(sorted(cur._params.iteritems()), default=repr))
+        for d in deps:
+            sha.update(memo[d])
+        memo[cur] = sha.hexdigest()
+    return memo[n]
+
+
 class ClassProperty(property):
     def __get__(self, cls, owner):
         return self.fget.__get__(None, owner)()
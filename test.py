@@ -2,9 +2,33 @@
 Nodetree test suite.
 """
 
+import os
+import json
+import pickle
+import shutil
+import tempfile
+import threading
 import unittest
 
-from nodetree import node, script, cache, exceptions, test_nodes
+from nodetree import node, script, cache, exceptions, test_nodes, transport, \
+        binary, journal, context
+
+
+def build_test_script():
+    s = script.Script({})
+    n1 = s.add_node("test_nodes.Number", "Val1", (("num", 2),))
+    n2 = s.add_node("test_nodes.Number", "Val2", (("num", 3),))
+    n3 = s.add_node("test_nodes.Arithmetic", "Add", (("operator", "+"),))
+    n4 = s.add_node("test_nodes.AddFive", "AddFive", ())
+    n3.set_input(0, n1)
+    n3.set_input(1, n2)
+    n4.set_input(0, n3)
+    return s
+
+
+def is_cached(s, name):
+    n = s.get_node(name)
+    return n._cacher.has_cache(n)
 
 
 class TestScript(unittest.TestCase):
@@ -49,21 +73,615 @@ class NodeTests(unittest.TestCase):
         term = self.script.get_node("AddFive")
         self.assertEqual(term.eval(), 4)
 
+    def test_non_storing_cacher(self):
+        class NullCacher(cache.BasicCacher):
+            def set_cache(self, node, data):
+                pass
+        s = script.Script({}, nodekwargs=dict(cacher=NullCacher()))
+        val = s.add_node("test_nodes.Number", "Val1", (("num", 2),))
+        add = s.add_node("test_nodes.AddFive", "AddFive", ())
+        add.set_input(0, val)
+        self.assertEqual(val.eval(), 2)
+        self.assertEqual(s.eval(), {"AddFive": 7})
+
     def test_set_invalid_value(self):
         n = self.script.get_node("Add")
         n.set_param("operator", "!")
         self.assertRaises(exceptions.ValidationError, n.validate)
 
     def _buildTestScript(self):
-        s = script.Script({})
-        n1 = s.add_node("test_nodes.Number", "Val1", (("num", 2),))
-        n2 = s.add_node("test_nodes.Number", "Val2", (("num", 3),))
-        n3 = s.add_node("test_nodes.Arithmetic", "Add", (("operator", "+"),))
-        n4 = s.add_node("test_nodes.AddFive", "AddFive", ())
-        n3.set_input(0, n1)
-        n3.set_input(1, n2)
-        n4.set_input(0, n3)
-        return s
+        return build_test_script()
+
+
+class ScriptEvalTests(unittest.TestCase):
+    def setUp(self):
+        self.script = build_test_script()
+
+    def test_eval_terminals(self):
+        self.assertEqual(self.script.eval(), {"AddFive": 10})
+        self.assertTrue(is_cached(self.script, "Val1"))
+
+    def test_schedule_order(self):
+        order = [n.label for n in self.script.schedule(
+                [self.script.get_node("AddFive")])]
+        self.assertEqual(order.index("AddFive"), 3)
+        self.assertEqual(order.index("Add"), 2)
+
+    def test_frugal(self):
+        self.assertEqual(self.script.eval(frugal=True), {"AddFive": 10})
+        self.assertTrue(is_cached(self.script, "AddFive"))
+        for name in ("Val1", "Val2", "Add"):
+            self.assertFalse(is_cached(self.script, name))
+        self.assertEqual(self.script.get_node("AddFive")._inputdata, [None])
+
+    def test_frugal_keep(self):
+        self.script.get_node("Val2").set_cache(7)
+        result = self.script.eval(["AddFive"], frugal=True, keep=["Add"])
+        self.assertEqual(result, {"AddFive": 14})
+        self.assertTrue(is_cached(self.script, "Add"))
+        self.assertTrue(is_cached(self.script, "Val2"))
+        self.assertFalse(is_cached(self.script, "Val1"))
+
+    def test_frugal_ignored(self):
+        self.script.get_node("Add").ignored = True
+        self.assertEqual(self.script.eval(frugal=True), {"AddFive": 7})
+        self.assertFalse(is_cached(self.script, "Val1"))
+
+
+class JournalTests(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.journal = journal.RunJournal(self.path)
+        build_test_script().eval(journal=self.journal)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def _fail(self, *args):
+        raise AssertionError("node was re-evaluated")
+
+    def test_resume(self):
+        s = build_test_script()
+        for name in ("Val1", "Val2", "Add", "AddFive"):
+            s.get_node(name).process = self._fail
+        result = s.eval(journal=journal.RunJournal(self.path))
+        self.assertEqual(result, {"AddFive": 10})
+
+    def test_resume_frontier(self):
+        s = build_test_script()
+        os.unlink(os.path.join(self.path,
+                self.journal._entries["AddFive"][1]))
+        for name in ("Val1", "Val2"):
+            s.get_node(name).process = self._fail
+        self.assertEqual(s.eval(journal=journal.RunJournal(self.path)),
+                {"AddFive": 10})
+
+    def test_stale(self):
+        s = build_test_script()
+        s.get_node("Val2").set_param("num", 4)
+        s.get_node("Val1").process = self._fail
+        j = journal.RunJournal(self.path)
+        self.assertFalse(j.is_complete(s.get_node("Add")))
+        self.assertEqual(s.eval(journal=j), {"AddFive": 11})
+        self.assertTrue(j.is_complete(s.get_node("Add")))
+
+    def test_clear(self):
+        self.journal.clear()
+        self.assertEqual(os.listdir(self.path), [])
+
+    def test_long_chain(self):
+        s = build_test_script()
+        prev = s.get_node("AddFive")
+        for i in range(1000):
+            n = s.add_node("test_nodes.AddFive", "Chain%d" % i, ())
+            n.set_input(0, prev)
+            prev = n
+        self.assertEqual(s.eval(["Chain999"], journal=self.journal),
+                {"Chain999": 5010})
+        self.assertTrue(self.journal.is_complete(prev))
+
+
+class SweepTests(unittest.TestCase):
+    def setUp(self):
+        self.script = build_test_script()
+        self.calls = []
+        for name in ("Val1", "Val2", "Add"):
+            self._count(self.script.get_node(name))
+
+    def _count(self, n):
+        process = n.process
+        def counted(*args):
+            self.calls.append(n.label)
+            return process(*args)
+        n.process = counted
+
+    def test_sweep(self):
+        sweep = {"Val1": {"num": [1, 2]}, "Val2": {"num": [10, 20, 30]}}
+        results = list(self.script.sweep(sweep))
+        self.assertEqual(len(results), 6)
+        self.assertEqual(results[0],
+                ({"Val1": {"num": 1}, "Val2": {"num": 10}}, {"AddFive": 16}))
+        self.assertEqual(results[-1][1], {"AddFive": 37})
+        self.assertEqual(self.calls.count("Val1"), 2)
+        self.assertEqual(self.calls.count("Val2"), 3)
+        self.assertEqual(self.calls.count("Add"), 6)
+
+    def test_sweep_order(self):
+        sweep = {"Add": {"operator": ["+", "*"]}, "Val1": {"num": [1, 2]}}
+        combos = [c for c, r in self.script.sweep(sweep)]
+        self.assertEqual([c["Val1"]["num"] for c in combos], [1, 1, 2, 2])
+        self.assertEqual(self.calls.count("Val1"), 2)
+
+    def test_params_restored(self):
+        list(self.script.sweep({"Val1": {"num": [5]}}))
+        self.assertEqual(self.script.get_node("Val1")._params, {"num": 2})
+        self.assertEqual(self.script.eval(), {"AddFive": 10})
+
+    def test_sweep_parallel(self):
+        sweep = {"Val1": {"num": [1, 2]}, "Val2": {"num": [10, 20]}}
+        self.assertEqual(list(self.script.sweep(sweep, processes=2)),
+                list(self.script.sweep(sweep)))
+
+    def test_sweep_parallel_shared_branches(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        def logged(n):
+            process = n.process
+            def run(*args):
+                with open(path, "a") as handle:
+                    handle.write(n.label + "\n")
+                return process(*args)
+            n.process = run
+        for name in ("Val1", "Val2"):
+            logged(self.script.get_node(name))
+        sweep = {"Val1": {"num": [1, 2]}, "Val2": {"num": [10, 20, 30]}}
+        try:
+            results = list(self.script.sweep(sweep, processes=2))
+            with open(path) as handle:
+                calls = handle.read().split()
+        finally:
+            os.unlink(path)
+        self.assertEqual(len(results), 6)
+        self.assertEqual(sorted(set(calls)), ["Val1", "Val2"])
+        self.assertEqual(len(calls), 5)
+
+    def test_sweep_parallel_ignored(self):
+        self.script.get_node("Add").ignored = True
+        sweep = {"Val1": {"num": [1, 2]}, "Val2": {"num": [0, 20]}}
+        results = list(self.script.sweep(sweep, processes=2))
+        self.assertEqual(results, list(self.script.sweep(sweep)))
+        self.assertEqual([r["AddFive"] for c, r in results], [6, 7, 6, 7])
+
+    def test_sweep_parallel_strings(self):
+        val = self.script.get_node("Val1")
+        val.process = lambda: "x" * val._params.get("num")
+        sweep = {"Val1": {"num": [1, 2]}}
+        results = list(self.script.sweep(sweep, ["Val1"], processes=2))
+        self.assertEqual(results, list(self.script.sweep(sweep, ["Val1"])))
+        self.assertEqual([r["Val1"] for c, r in results], ["x", "xx"])
+
+    @unittest.skipIf(transport.numpy is None, "numpy not installed")
+    def test_sweep_parallel_shared(self):
+        numpy = transport.numpy
+        val = self.script.get_node("Val1")
+        val.process = lambda: numpy.arange(val._params.get("num"))
+        results = list(self.script.sweep({"Val1": {"num": [1, 2]}},
+                ["Val1"], processes=2))
+        self.assertTrue(all(isinstance(r["Val1"], numpy.ndarray) \
+                for c, r in results))
+        self.assertEqual([r["Val1"].tolist() for c, r in results],
+                [[0], [0, 1]])
+
+
+class FusionTests(unittest.TestCase):
+    def setUp(self):
+        self.script = build_test_script()
+        prev = self.script.get_node("AddFive")
+        for i in range(3):
+            n = self.script.add_node("test_nodes.AddFive", "Chain%d" % i, ())
+            n.set_input(0, prev)
+            prev = n
+        self.term = self.script.add_node("test_nodes.Arithmetic", "Term",
+                (("operator", "+"),))
+        self.term.set_input(0, prev)
+        self.term.set_input(1, self.script.get_node("Val1"))
+
+    def test_fuse(self):
+        hashes = dict((n.label, n.hash_value()) for n in self.script.get_terminals())
+        fused = self.script.fuse()
+        self.assertEqual(len(fused), 1)
+        self.assertEqual([n.label for n in fused[0].chain],
+                ["AddFive", "Chain0", "Chain1", "Chain2"])
+        self.assertEqual(self.term.input(0), fused[0])
+        self.assertEqual(fused[0].hash_value(),
+                self.script.get_node("Chain2").hash_value())
+        self.assertEqual(dict((n.label, n.hash_value()) for n \
+                in self.script.get_terminals()), hashes)
+        self.assertEqual(self.script.eval(), {"Term": 27})
+        chain2 = self.script.get_node("Chain2")
+        self.assertEqual(chain2._cacher.get_cache(chain2), 25)
+        self.assertFalse(self.script.get_node("Chain0")._cacher.has_cache(
+                self.script.get_node("Chain0")))
+
+    def test_fuse_keep(self):
+        fused = self.script.fuse(keep=["Chain0"])
+        self.assertEqual([[n.label for n in f.chain] for f in fused],
+                [["AddFive", "Chain0"], ["Chain1", "Chain2"]])
+        self.assertEqual(self.script.eval(), {"Term": 27})
+
+    def test_fused_invalidation(self):
+        self.script.fuse()
+        self.assertEqual(self.script.eval(), {"Term": 27})
+        self.script.get_node("Val1").set_param("num", 3)
+        self.assertEqual(self.script.eval(), {"Term": 29})
+
+    def test_fused_member_ignored(self):
+        self.script.fuse()
+        self.assertEqual(self.script.eval(), {"Term": 27})
+        chain1 = self.script.get_node("Chain1")
+        chain1.ignored = True
+        chain1.mark_dirty()
+        self.assertEqual(self.script.eval(), {"Term": 22})
+        self.script.unfuse()
+        self.assertEqual(self.script.eval(), {"Term": 22})
+
+    def test_fused_type_mismatch(self):
+        self.script.get_node("Chain0").outtype = str
+        fused = self.script.fuse()
+        self.assertRaises(exceptions.ValidationError, fused[0].validate)
+        self.assertRaises(exceptions.ValidationError, self.script.eval)
+
+    def test_error_attribution(self):
+        def fail(data):
+            raise ValueError("bad data")
+        self.script.get_node("Chain1").process = fail
+        self.script.fuse()
+        try:
+            self.term.eval()
+        except ValueError, err:
+            self.assertEqual(err.node, self.script.get_node("Chain1"))
+        else:
+            self.fail("error not raised")
+
+    def test_fuse_terminal_chain(self):
+        self.term.set_input(0, None)
+        fused = self.script.fuse()
+        self.assertEqual([n.label for n in fused[0].chain],
+                ["AddFive", "Chain0", "Chain1", "Chain2"])
+        self.assertTrue("Chain2" in [n.label for n in self.script.get_terminals()])
+        self.assertEqual(self.script.eval(["Chain2"]), {"Chain2": 25})
+        chain0 = self.script.get_node("Chain0")
+        self.assertFalse(chain0._cacher.has_cache(chain0))
+
+    def test_unfuse(self):
+        ser = self.script.serialize()
+        self.script.fuse()
+        self.assertEqual(self.script.serialize(), ser)
+        self.script.unfuse()
+        self.assertEqual(self.term.input(0), self.script.get_node("Chain2"))
+        self.assertEqual(self.script.eval(), {"Term": 27})
+
+    def test_unfuse_terminal_chain(self):
+        self.term.set_input(0, None)
+        self.script.fuse()
+        self.script.unfuse()
+        chain2 = self.script.get_node("Chain2")
+        self.assertEqual(chain2._parents, [])
+        self.assertEqual(self.script.fuse()[0].chain[-1], chain2)
+
+    def test_fused_context_inputs(self):
+        ctx = lambda: context.EvalContext(inputs={"Chain0": 100})
+        self.assertEqual(self.script.eval(context=ctx()), {"Term": 112})
+        self.script.fuse()
+        self.assertEqual(self.script.eval(context=ctx()), {"Term": 112})
+        self.assertEqual(self.script.eval(), {"Term": 27})
+        shared = context.EvalContext(inputs={"Chain0": 100},
+                shared_cache=True)
+        self.assertEqual(self.script.eval(context=shared), {"Term": 112})
+
+    def test_fused_context_shared_cache(self):
+        self.script.fuse()
+        self.assertEqual(self.script.eval(), {"Term": 27})
+        ctx = context.EvalContext(inputs={"Chain1": 0}, shared_cache=True)
+        self.assertFalse(ctx.is_clean(self.term.input(0)))
+        self.assertEqual(self.script.eval(["Term"], context=ctx),
+                {"Term": 7})
+
+    def test_fused_empty_diff(self):
+        fused = self.script.fuse()
+        self.assertEqual(self.script.eval(), {"Term": 27})
+        ser = self.script.serialize()
+        self.script.apply_diff(ser, ser)
+        self.assertEqual(self.term.input(0), fused[0])
+        self.assertTrue(self.term._cacher.has_cache(self.term))
+
+    def test_fused_diff_rewire(self):
+        self.script.fuse()
+        old = self.script.serialize()
+        new = self.script.serialize()
+        new["Chain1"]["inputs"] = ["AddFive"]
+        self.script.apply_diff(old, new)
+        self.assertEqual(self.term.input(0), self.script.get_node("Chain2"))
+        self.assertEqual(self.script.eval(["Term"]), {"Term": 22})
+
+
+class ContextTests(unittest.TestCase):
+    def setUp(self):
+        self.script = build_test_script()
+
+    def test_context_eval(self):
+        ctx = context.EvalContext(params={"Val2": {"num": 10}})
+        self.assertEqual(self.script.eval(context=ctx), {"AddFive": 17})
+        self.assertEqual(self.script.get_node("Val2")._params, {"num": 3})
+        self.assertFalse(is_cached(self.script, "Add"))
+        self.assertEqual(self.script.eval(), {"AddFive": 10})
+
+    def test_context_inputs(self):
+        ctx = context.EvalContext(inputs={"Add": 100})
+        self.assertEqual(self.script.eval(context=ctx), {"AddFive": 105})
+        self.assertFalse(self.script.get_node("Val1") in ctx.results)
+
+    def test_shared_cache(self):
+        self.script.eval()
+        self.script.get_node("Val1").process = None
+        ctx = context.EvalContext(params={"Val2": {"num": 10}},
+                shared_cache=True)
+        self.assertEqual(self.script.eval(context=ctx), {"AddFive": 17})
+        self.assertEqual(self.script.get_node("AddFive")._cacher.get_cache(
+                self.script.get_node("AddFive")), 10)
+
+    def test_threads(self):
+        results = {}
+        def run(num):
+            ctx = context.EvalContext(params={"Val1": {"num": num}})
+            results[num] = self.script.eval(context=ctx)["AddFive"]
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(20)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(results, dict((i, i + 8) for i in range(20)))
+
+    def test_context_excludes_cache_options(self):
+        ctx = context.EvalContext()
+        self.assertRaises(exceptions.ScriptError, self.script.eval,
+                context=ctx, frugal=True)
+        self.assertRaises(exceptions.ScriptError, self.script.eval,
+                context=ctx, keep=["Add"])
+
+    def test_fused_context(self):
+        n = self.script.add_node("test_nodes.AddFive", "AddTen", ())
+        n.set_input(0, self.script.get_node("AddFive"))
+        self.assertEqual(len(self.script.fuse()), 1)
+        ctx = context.EvalContext(params={"Add": {"operator": "*"}})
+        self.assertEqual(self.script.eval(context=ctx), {"AddTen": 16})
+        self.assertEqual(self.script.eval(), {"AddTen": 15})
+
+
+class ScriptDiffTests(unittest.TestCase):
+    def setUp(self):
+        self.script = build_test_script()
+        self.script.get_node("AddFive").eval()
+
+    def test_change_param(self):
+        old = self.script.serialize()
+        new = self.script.serialize()
+        new["Val2"]["params"] = [("num", 4)]
+        diff = self.script.apply_diff(old, new)
+        self.assertEqual(diff.params, {"Val2": {"num": 4}})
+        self.assertTrue(is_cached(self.script, "Val1"))
+        self.assertFalse(is_cached(self.script, "Val2"))
+        self.assertFalse(is_cached(self.script, "AddFive"))
+        self.assertEqual(self.script.get_node("AddFive").eval(), 11)
+        self.assertEqual(self.script.serialize(), new)
+
+    def test_add_and_rewire(self):
+        old = self.script.serialize()
+        new = self.script.serialize()
+        new["Val3"] = dict(type="test_nodes.Number", inputs=[],
+                params=[("num", 10)])
+        new["Add"]["inputs"] = ["Val1", "Val3"]
+        self.script.apply_diff(script.ScriptDiff(old, new))
+        val2 = self.script.get_node("Val2")
+        self.assertTrue(is_cached(self.script, "Val1"))
+        self.assertFalse(val2.has_parents())
+        self.assertEqual(self.script.get_node("AddFive").eval(), 17)
+        self.assertEqual(self.script.serialize(), new)
+
+    def test_remove_and_retype(self):
+        old = self.script.serialize()
+        new = self.script.serialize()
+        del new["Val2"]
+        new["Add"]["inputs"] = ["Val1", "Val1"]
+        new["Val1"] = dict(type="test_nodes.AddFive", inputs=["Seed"],
+                params=[])
+        new["Seed"] = dict(type="test_nodes.Number", inputs=[],
+                params=[("num", 1)])
+        self.script.apply_diff(old, new)
+        self.assertEqual(self.script.get_node("Val2"), None)
+        self.assertEqual(self.script.get_node("AddFive").eval(), 17)
+        self.assertEqual(self.script.serialize(), new)
+
+    def test_empty_diff(self):
+        ser = self.script.serialize()
+        diff = self.script.apply_diff(ser, ser)
+        self.assertTrue(diff.is_empty())
+        self.assertTrue(is_cached(self.script, "AddFive"))
+
+
+class BinaryFormatTests(unittest.TestCase):
+    def setUp(self):
+        self.script = build_test_script()
+
+    def test_round_trip(self):
+        ser = self.script.serialize()
+        self.assertEqual(binary.loads(binary.dumps(ser)), ser)
+
+    def test_round_trip_values(self):
+        ser = {
+            "__meta": {"version": 2},
+            "Val1": dict(type="test_nodes.Number", inputs=[],
+                params=[("num", -300), ("scale", 1.5), ("name", u"p\xe4ge"),
+                    ("range", [1, (2, None)])], ignored=True),
+            "Add": dict(type="test_nodes.Arithmetic", inputs=["Val1", "Missing"],
+                params=[], __pos=(10, 20)),
+        }
+        self.assertEqual(binary.loads(binary.dumps(ser)), ser)
+
+    def test_round_trip_json(self):
+        ser = json.loads(json.dumps(self.script.serialize()))
+        self.assertEqual(type(ser["Val1"]["params"][0]), list)
+        decoded = binary.loads(binary.dumps(ser))
+        self.assertEqual(decoded, ser)
+        self.assertEqual(type(decoded["Val1"]["params"][0]), list)
+
+    def test_from_binary(self):
+        s = script.Script.from_binary(self.script.serialize_binary())
+        self.assertEqual(s.serialize(), self.script.serialize())
+        self.assertEqual(s.get_node("AddFive").eval(), 10)
+
+    def test_bad_version(self):
+        data = bytearray(self.script.serialize_binary())
+        data[5] = 99
+        self.assertRaises(exceptions.ScriptError, binary.loads, bytes(data))
+
+    def test_circular(self):
+        ser = self.script.serialize()
+        ser["Val1"]["inputs"] = ["AddFive"]
+        self.assertRaises(exceptions.CircularDagError, binary.dumps, ser)
+
+
+class TransportTests(unittest.TestCase):
+    def setUp(self):
+        self.transport = transport.SharedMemoryTransport()
+
+    def tearDown(self):
+        self.transport.clear()
+
+    def test_put_get_bytes(self):
+        handle = self.transport.put(bytearray(b"page image"))
+        self.assertTrue(isinstance(handle, transport.SegmentHandle))
+        self.assertEqual(bytes(self.transport.get(handle)), b"page image")
+
+    def test_str_passthrough(self):
+        if bytes is str:
+            self.assertEqual(self.transport.put("page text"), "page text")
+
+    def test_non_buffer_passthrough(self):
+        self.assertEqual(self.transport.put(10), 10)
+        self.assertEqual(self.transport.get(10), 10)
+
+    def test_attach_from_handle(self):
+        handle = pickle.loads(pickle.dumps(
+                self.transport.put(bytearray(b"abc"))))
+        other = transport.SharedMemoryTransport()
+        self.assertEqual(bytes(other.get(handle)), b"abc")
+        other.clear()
+        self.assertTrue(os.path.exists(handle.path))
+
+    def test_release(self):
+        handle = self.transport.put(bytearray(b"abc"))
+        self.transport.release(handle)
+        self.assertFalse(os.path.exists(handle.path))
+
+    @unittest.skipIf(transport.numpy is None, "numpy not installed")
+    def test_ndarray_zero_copy(self):
+        numpy = transport.numpy
+        arr = numpy.arange(12, dtype=numpy.uint16).reshape(3, 4)
+        handle = self.transport.put(arr)
+        first, second = self.transport.get(handle), self.transport.get(handle)
+        self.assertTrue((first == arr).all())
+        first[0, 0] = 99
+        self.assertEqual(second[0, 0], 99)
+
+    @unittest.skipIf(transport.numpy is None, "numpy not installed")
+    def test_allocate_output(self):
+        s = script.Script({}, nodekwargs=dict(cacher=cache.SharedMemoryCacher()))
+        n = s.add_node("test_nodes.Number", "Val1", ())
+        def process():
+            out = n.allocate_output((2, 3), "uint8")
+            out[...] = 7
+            self.allocated = out
+            return out
+        n.process = process
+        n.eval()
+        handle = n._cacher.get_handle(n)
+        self.assertEqual(handle.shape, (2, 3))
+        self.allocated[0, 0] = 1
+        self.assertEqual(n._cacher.get_cache(n)[0, 0], 1)
+
+    def test_shared_memory_cacher(self):
+        s = script.Script({}, nodekwargs=dict(cacher=cache.SharedMemoryCacher()))
+        n = s.add_node("test_nodes.Number", "Val1", (("num", 2),))
+        n.set_cache(bytearray(b"data"))
+        handle = n._cacher.get_handle(n)
+        self.assertEqual(bytes(n.eval()), b"data")
+        n.mark_dirty()
+        self.assertFalse(os.path.exists(handle.path))
+
+    def test_shared_memory_cacher_strings(self):
+        s = script.Script({}, nodekwargs=dict(cacher=cache.SharedMemoryCacher()))
+        src = s.add_node("test_nodes.Number", "Src", (("num", "page text"),))
+        upper = s.add_node("test_nodes.AddFive", "Upper", ())
+        upper.set_input(0, src)
+        upper.process = lambda text: text.upper()
+        self.assertEqual(s.eval(), {"Upper": "PAGE TEXT"})
+
+
+class SpillCacherTests(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.cacher = cache.SpillCacher(threshold=16, directory=self.path)
+        s = script.Script({}, nodekwargs=dict(cacher=self.cacher))
+        self.small = s.add_node("test_nodes.Number", "Small", ())
+        self.large = s.add_node("test_nodes.Number", "Large", ())
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_spill_threshold(self):
+        self.small.set_cache(b"tiny")
+        self.large.set_cache(bytearray(b"x" * 32))
+        self.assertEqual(self.cacher.get_cache(self.small), b"tiny")
+        self.assertEqual(bytes(self.cacher.get_cache(self.large)), b"x" * 32)
+        self.assertEqual(len(os.listdir(self.path)), 1)
+
+    def test_strings_not_spilled(self):
+        s = script.Script({}, nodekwargs=dict(cacher=self.cacher))
+        src = s.add_node("test_nodes.Number", "Src", (("num", "page text" * 4),))
+        upper = s.add_node("test_nodes.AddFive", "Upper", ())
+        upper.set_input(0, src)
+        upper.process = lambda text: text.upper()
+        self.assertEqual(s.eval(), {"Upper": "PAGE TEXT" * 4})
+        if bytes is str:
+            self.assertEqual(os.listdir(self.path), [])
+
+    def test_clear_removes_files(self):
+        self.large.set_cache(bytearray(b"x" * 32))
+        self.cacher.clear_cache(self.large)
+        self.assertEqual(os.listdir(self.path), [])
+        self.large.set_cache(bytearray(b"x" * 32))
+        self.cacher.clear()
+        self.assertEqual(os.listdir(self.path), [])
+
+    @unittest.skipIf(transport.numpy is None, "numpy not installed")
+    def test_consumer_gets_view(self):
+        numpy = transport.numpy
+        self.large.set_param("num", numpy.ones(8, dtype=numpy.int64))
+        s = script.Script({}, nodekwargs=dict(cacher=self.cacher))
+        add = s.add_node("test_nodes.AddFive", "AddFive", ())
+        add.set_input(0, self.large)
+        self.assertEqual(list(add.eval()), [6] * 8)
+        self.assertTrue(add._inputdata[0].base is not None)
+
+    @unittest.skipIf(transport.numpy is None, "numpy not installed")
+    def test_spill_ndarray(self):
+        numpy = transport.numpy
+        arr = numpy.ones((4, 4), dtype=numpy.float64)
+        self.large.set_cache(arr)
+        cached = self.large.eval()
+        self.assertEqual(cached.shape, (4, 4))
+        self.assertTrue((cached == arr).all())
 
 
 if __name__ == '__main__':